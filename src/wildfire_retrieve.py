@@ -10,11 +10,32 @@ https://software.ecmwf.int/wiki/display/WEBAPI/Accessing+ECMWF+data+servers+in+b
 @author: Guy Griffiths
 '''
 
+import sys
+if sys.version_info < (3, 8):
+    raise ImportError('wildfire_retrieve requires Python 3.8 or later')
+
 import os.path
-from datetime import date, timedelta
-from ecmwfapi import ECMWFDataServer
-from multiprocessing import Pool, Manager
-import traceback
+import base64
+import hashlib
+import json
+import logging
+import random
+import shutil
+import socket
+import subprocess
+import time
+from datetime import date
+from functools import lru_cache, partial
+from itertools import cycle
+from http.client import HTTPException
+from ecmwfapi.api import Connection, APIException, RetryError
+from multiprocessing.pool import ThreadPool
+from threading import Lock, BoundedSemaphore
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin
+from urllib.request import urlopen
+
+logger = logging.getLogger(__name__)
 
 class WildfireTiggeDataRetriever():
     ''' This class is a data downloader for data from the TIGGE dataset on the ECMWF MARS system.
@@ -27,13 +48,22 @@ class WildfireTiggeDataRetriever():
     You should make a note of the values given on that page for "Your registered email" and "Your api key".
     They will be needed when instantiating this class.
     '''
+    # The ECMWF web API endpoint
+    api_url = 'https://api.ecmwf.int/v1'
+    # ECMWF allows 3 active requests per user, so we allow 4 outstanding requests per user
+    # to ensure that the pending requests get submitted immediately.
+    # Could be set to 6, but 4 seemed to be quicker (not tested extensively though)
+    requests_per_key = 4
     # The first available date in TIGGE
     start_date = date(2007,3,5)
     # These dates are not available.
-    missing_dates = [(2015, 12, 3),(2015, 12, 10),(2015, 12, 16),(2015, 12, 17),(2015, 12, 18),
-                     (2015, 12, 19),(2016, 6, 24),(2016, 6, 28),(2016, 6, 29),(2016, 6, 30),
-                     (2016, 7, 1),(2016, 7, 2),(2016, 7, 3),(2016, 8, 6),(2016, 8, 10),
-                     (2016, 8, 23),(2016, 8, 24),(2016, 8, 25),(2016, 8, 28)]
+    missing_dates = frozenset([(2015, 12, 3),(2015, 12, 10),(2015, 12, 16),(2015, 12, 17),(2015, 12, 18),
+                               (2015, 12, 19),(2016, 6, 24),(2016, 6, 28),(2016, 6, 29),(2016, 6, 30),
+                               (2016, 7, 1),(2016, 7, 2),(2016, 7, 3),(2016, 8, 6),(2016, 8, 10),
+                               (2016, 8, 23),(2016, 8, 24),(2016, 8, 25),(2016, 8, 28)])
+    # Other forecasts whose requests MARS aborts are recorded, and not requested again
+    # until this many seconds have passed, in case the failure was only temporary
+    unavailable_recheck_interval = 24 * 60 * 60
     
     # The set of parameter IDs for (in order):
     # 10m u wind component
@@ -45,6 +75,22 @@ class WildfireTiggeDataRetriever():
     # The set of parameter IDs for all available variables which can be retrieved in a single request
     all_vars = '59/134/136/146/147/151/165/166/167/168/172/176/177/179/235/228001/228039/228139/228144/228228'
     
+    # The parts of the ECMWF request which are the same for every forecast
+    request_template = {
+        "class": "ti",
+        "type": "cf",
+        "dataset": "tigge",
+        "expver": "prod",
+        "grid": "0.5/0.5",
+        "levtype": "sfc",
+        "origin": "kwbc",
+        "format": "netcdf",
+        "step": "0/6/12/18/24/30/36/42/48/54/60/66/72/78/84/90/96/102/108/114/120/126/132/138/144/150/156/162/168/174/180/186/192/198/204/210/216/222/228/234/240",
+        "area": "14/-82/-57/-31"
+    }
+    full_request_template = dict(request_template, param=all_vars)
+    reduced_request_template = dict(request_template, param=minimal_vars)
+    
     def __init__(self, data_path, keys):
         ''' Instantiate a new WildfireTiggeDataRetriever
         :param data_path: The directory in which to store downloaded data
@@ -60,46 +106,144 @@ class WildfireTiggeDataRetriever():
             raise ValueError('Need to supply at least one ECMWF API key')
         self.path = data_path
         self.keys = keys
-        self.current_key = 0
-        self.lock = Manager().Lock()
+        # Limits the number of outstanding MARS requests for each user
+        self._request_slots = {key[1]: BoundedSemaphore(WildfireTiggeDataRetriever.requests_per_key) for key in keys}
+        self._key_cycle = cycle(keys)
+        # All of the work happens in threads of this process, so a plain lock is enough
+        self.lock = Lock()
+        # Requests which have been submitted to MARS but not yet downloaded.  These are kept on
+        # disk so that an interrupted run can pick up the existing requests rather than queueing again
+        self._request_cache_path = data_path + '.mars_requests.json'
+        # Forecasts which MARS has recently failed to retrieve, with the time of the failure
+        self._unavailable_path = data_path + '.unavailable.json'
+        with self.lock:
+            self._request_cache = self._load_request_cache()
+            self._unavailable = self._load_unavailable()
     
-    def bulk_download(self, end_date = None, start_date = None, force=False, reduced_set=False):
+    def bulk_download(self, end_date = None, start_date = None, force=False, reduced_set=False, local_conversion=False):
         ''' Download data in bulk.  This uses a multithreaded approach to make 4 simultaneous requests per API key,
-        to speed up data retrieval.
+        to speed up data retrieval.  The work is almost entirely waiting on the network, so threads are used
+        rather than processes.
         :param end_date: The date to download data up until.  Optional, defaults to today
         :param start_date: The first date to download data from.  Optional, defaults to 2007-03-05 (the first date available)
         :param force: Whether to download data which has already been downloaded.  Optional, defaults to False
         :param reduced_set: Whether to download a reduced set of fields to save space.  Optional, defaults to False
+        :param local_conversion: Whether to download GRIB and convert it to NetCDF locally.  Optional, defaults to False
         :type end_date: datetime.date
         :type start_date: datetime.date
         :type force: boolean
         :type reduced_set: boolean
+        :type local_conversion: boolean
         '''
         # No date specified.  Try and download up to today.
         # This will fail on many of the more recent dates
         if end_date is None:
             end_date = date.today()
-        # ECMWF allows 3 active requests per user, so we create a pool of 4 requests per user
-        # to ensure that the pending requests get submitted immediately.
-        # Could be set to 6, but 4 seemed to be quicker (not tested extensively though)
-        size = len(self.keys) * 4
-        worker_pool = Pool(size)
+        # A request gives up its slot as soon as it is finished on MARS, so allow as many
+        # threads again for downloading.  This keeps the MARS queue full while files download.
+        size = len(self.keys) * WildfireTiggeDataRetriever.requests_per_key * 2
         if start_date is None:
-            current_date = WildfireTiggeDataRetriever.start_date
-        else:
-            current_date = start_date
-        args = []
-        while current_date <= end_date:
-            args.append((self,current_date.year, current_date.month, current_date.day, 0, self._get_ecmwf_key(), force, reduced_set))
-            args.append((self,current_date.year, current_date.month, current_date.day, 6, self._get_ecmwf_key(), force, reduced_set))
-            args.append((self,current_date.year, current_date.month, current_date.day, 12, self._get_ecmwf_key(), force, reduced_set))
-            args.append((self,current_date.year, current_date.month, current_date.day, 18, self._get_ecmwf_key(), force, reduced_set))
-            current_date += timedelta(days=1)
+            start_date = WildfireTiggeDataRetriever.start_date
+        if local_conversion:
+            __check_grib_to_netcdf__()
+        self._remove_partial_downloads()
+        # List the data directory once rather than checking for each file in turn
+        existing = self._prescan_existing()
+        # With the directory listing in hand, this is just a lookup per forecast
+        logger.info('%d forecasts to download', sum(1 for _ in self._forecasts_needed(start_date, end_date, force, reduced_set, existing)))
+        # The pool would otherwise read every forecast into its queue straight away, so only let
+        # as many forecasts be queued as there are threads to work on them
+        queue_slots = BoundedSemaphore(size)
+        args = self._forecasts_to_download(start_date, end_date, force, reduced_set, local_conversion, existing, queue_slots)
+        worker_pool = ThreadPool(size)
         # chunksize=1 means that we mostly keep the order of file retrieval intact
-        # without it, we get downloads in a more random order, which is less efficient on MARS
-        worker_pool.map(__get_data_wrapper__, args, chunksize=1)
+        # without it, we get downloads in a more random order, which is less efficient on MARS.
+        try:
+            for _ in worker_pool.imap_unordered(partial(self._get_data_wrapper, queue_slots), args, chunksize=1):
+                pass
+            worker_pool.close()
+            worker_pool.join()
+        finally:
+            # Only does anything if the download was interrupted, in which case the threads need stopping
+            worker_pool.terminate()
     
-    def get_data(self, year, month, day, hour, key, force=False, reduced_set=False):
+    def _forecasts_needed(self, start_date, end_date, force, reduced_set, existing=None):
+        ''' Generates the (year, month, day, hour) of each forecast in a date range which needs
+        downloading (or every forecast, if force is set), in date order.  Skipping the others
+        means that the requests which do get submitted are contiguous in date order.
+        
+        :param start_date: The first date to download data from
+        :param end_date: The date to download data up until
+        :param force: Whether to download data which has already been downloaded
+        :param reduced_set: Whether to download a reduced set of fields
+        :param existing: The sizes of the data files on disk, from _prescan_existing.  Optional
+        :type start_date: datetime.date
+        :type end_date: datetime.date
+        :type force: boolean
+        :type reduced_set: boolean
+        :type existing: dict
+        '''
+        for ordinal in range(start_date.toordinal(), end_date.toordinal() + 1):
+            current_date = date.fromordinal(ordinal)
+            for hour in (0, 6, 12, 18):
+                if force or self.need_to_download(current_date.year, current_date.month, current_date.day, hour, reduced_set, existing=existing):
+                    yield (current_date.year, current_date.month, current_date.day, hour)
+    
+    def _forecasts_to_download(self, start_date, end_date, force, reduced_set, local_conversion, existing, queue_slots):
+        ''' Generates the arguments for _get_data_wrapper for each forecast in a date range which
+        needs downloading, assigning the ECMWF keys in turn.
+        
+        Each forecast takes one of queue_slots before it is generated, which
+        _get_data_wrapper gives back once it has finished with the forecast.
+        
+        :param start_date: The first date to download data from
+        :param end_date: The date to download data up until
+        :param force: Whether to download data which has already been downloaded
+        :param reduced_set: Whether to download a reduced set of fields
+        :param local_conversion: Whether to download GRIB and convert it to NetCDF locally
+        :param existing: The sizes of the data files on disk, from _prescan_existing
+        :param queue_slots: Limits the number of forecasts queued in the worker pool
+        :type start_date: datetime.date
+        :type end_date: datetime.date
+        :type force: boolean
+        :type reduced_set: boolean
+        :type local_conversion: boolean
+        :type existing: dict
+        :type queue_slots: threading.BoundedSemaphore
+        '''
+        for year, month, day, hour in self._forecasts_needed(start_date, end_date, force, reduced_set, existing):
+            queue_slots.acquire()
+            yield (year, month, day, hour, self._get_ecmwf_key(), force, reduced_set, local_conversion)
+    
+    def _get_data_wrapper(self, queue_slots, args):
+        ''' Wraps the get_data method for use in the worker pool, so that a failure in one request
+        is reported without stopping the rest of the pool.  Transient errors are retried, which
+        resumes the same MARS request from the request cache.
+        
+        :param queue_slots: The semaphore which the forecast took a slot from when it was queued
+        :param args: The arguments to get_data
+        :type queue_slots: threading.BoundedSemaphore
+        :type args: tuple
+        '''
+        try:
+            attempts = 5
+            for attempt in range(attempts):
+                try:
+                    self.get_data(*args)
+                    return
+                except Exception as e:
+                    if not __is_transient__(e) or attempt == attempts - 1:
+                        logger.exception('Problem with args: %s %s %s %s %s %s %s %s', *args)
+                        return
+                    delay = 2 ** attempt + random.random()
+                    logger.warning('Problem with args: %s %s %s %s %s %s %s %s: %s.  Retrying in %.1f seconds',
+                                   *(args + (e, delay)))
+                    time.sleep(delay)
+        finally:
+            # Let the next forecast be queued
+            queue_slots.release()
+    
+    def get_data(self, year, month, day, hour, key, force=False, reduced_set=False, local_conversion=False):
         ''' Retrieves wildfire data for a given date + time.
         
         THIS METHOD RETRIEVES DATA SYNCHRONOUSLY AND WILL NOT RETURN UNTIL DATA IS DOWNLOADED.
@@ -112,78 +256,355 @@ class WildfireTiggeDataRetriever():
         :param month: The desired month of the data to retrieve
         :param day: The desired day of the data to retrieve
         :param hour: The desired hour of the data to retrieve (0,6,12,18)
+        :param key: The ECMWF API key/email pair to use
         :param force: Whether to download the data even if it already exists on disk
         :param reduced_set: Whether a reduced set of variables is being retrieved
+        :param local_conversion: Whether to download the data as GRIB and convert it to NetCDF locally.
+                                 GRIB is considerably smaller than the NetCDF which MARS produces, but
+                                 this needs the grib_to_netcdf tool from ecCodes to be installed
         :type year: int
         :type month: int
         :type day: int
         :type hour: int
+        :type key: tuple
         :type force: boolean
         :type reduced_set: boolean
+        :type local_conversion: boolean
         
         :returns: Nothing.  Returns when data download is finished.
         '''
+        filename = self._get_filename(year, month, day, hour, reduced_set)
         # Only download if file doesn't exist and we haven't forced a redownload
-        if not self.need_to_download(year, month, day, hour, reduced_set) and not force:
-            print 'Already downloaded',self._get_filename(year, month, day, hour, reduced_set),'not redownloading'
+        if not force and not self.need_to_download(year, month, day, hour, reduced_set, filename):
+            if self._is_unavailable(year, month, day, hour):
+                logger.info('%s is not available from MARS, not requesting it', __format_forecast__(year, month, day, hour))
+            else:
+                logger.info('Already downloaded %s, not redownloading', filename)
             return
 
-        server = ECMWFDataServer('https://api.ecmwf.int/v1',key[0], key[1])
-        
         # Get the full set of variables?
         if reduced_set:
-            variable_ids = WildfireTiggeDataRetriever.minimal_vars
+            request_params = WildfireTiggeDataRetriever.reduced_request_template.copy()
         else: 
-            variable_ids = WildfireTiggeDataRetriever.all_vars 
-        
-        # The dictionary for the ECMWF request
-        request_params = {
-            "class": "ti",
-            "type": "cf",
-            "dataset": "tigge",
-            "expver": "prod",
-            "grid": "0.5/0.5",
-            "levtype": "sfc",
-            "origin": "kwbc",
-            "format": "netcdf",
-            "step": "0/6/12/18/24/30/36/42/48/54/60/66/72/78/84/90/96/102/108/114/120/126/132/138/144/150/156/162/168/174/180/186/192/198/204/210/216/222/228/234/240",
-            "date": __format_date__(year, month, day),
-            "param": variable_ids,
-            "time": __format_time__(hour),
-            "target": self._get_filename(year, month, day, hour, reduced_set),
-            "area": "14/-82/-57/-31"
-        }
-        server.retrieve(request_params)
-    
-    def need_to_download(self, year, month, day, hour, reduced_set=False):
+            request_params = WildfireTiggeDataRetriever.full_request_template.copy()
+        
+        # Fill in the forecast-specific parts of the ECMWF request
+        request_params["date"] = __format_date__(year, month, day)
+        request_params["time"] = __format_time__(hour)
+        request_params["target"] = filename
+        if local_conversion:
+            # Don't wait for the request to go through the MARS queue only to find it can't be converted
+            __check_grib_to_netcdf__()
+            request_params["format"] = "grib"
+        connection = self._submit_request(key, request_params)
+        if connection.status != 'aborted':
+            try:
+                self._await_and_download(connection, request_params['target'], local_conversion)
+            except APIException:
+                # Other API errors leave the request to be resumed (or resubmitted) next time
+                if connection.status != 'aborted':
+                    raise
+        if connection.status == 'aborted':
+            # MARS accepted the request but could not fulfil it, usually because the data is missing.
+            # There is no point resuming a failed request, so it can be forgotten.
+            self._forget_request(request_params['target'])
+            self._mark_unavailable(year, month, day, hour)
+            logger.warning('MARS could not retrieve %s, not requesting it again for %d hours',
+                           __format_forecast__(year, month, day, hour),
+                           WildfireTiggeDataRetriever.unavailable_recheck_interval // 3600)
+    
+    def need_to_download(self, year, month, day, hour, reduced_set=False, filename=None, existing=None):
         ''' Will check whether or not the specified forecast needs to be downloaded.
-        This will depend on whether or not it is a defined missing date, and whether the file
-        already exists, and contains some data)
+        This will depend on whether or not it is a defined missing date, whether MARS has recently
+        failed to retrieve it, and whether the file already exists, and contains some data)
                 
         :param year: The desired year of the data to retrieve
         :param month: The desired month of the data to retrieve
         :param day: The desired day of the data to retrieve
         :param hour: The desired hour of the data to retrieve (0,6,12,18)
         :param reduced_set: Whether a reduced set of variables is being retrieved
+        :param filename: The filename for this forecast, if already known.  Optional
+        :param existing: The sizes of the data files on disk, from _prescan_existing.  Optional, the disk is checked if not given
         :type year: int
         :type month: int
         :type day: int
         :type hour: int
         :type reduced_set: boolean
+        :type filename: string
+        :type existing: dict
         
         :returns: Whether this data file needs to be download
         :rtype: boolean        
         '''
         # First check if this is an unavailable date. 
-        if (year,month,day) in WildfireTiggeDataRetriever.missing_dates:
+        if self._is_unavailable(year, month, day, hour):
             return False
         # Now check if the file already exists and has a size > 0
-        filename = self._get_filename(year, month, day, hour, reduced_set)
+        if filename is None:
+            filename = self._get_filename(year, month, day, hour, reduced_set)
+        if existing is not None:
+            return existing.get(os.path.basename(filename), 0) == 0
         if os.path.isfile(filename):
             if os.path.getsize(filename) > 0:
                 return False
         return True
     
+    def _prescan_existing(self):
+        ''' Records the size of every data file in the data directory, so that need_to_download
+        can look files up rather than checking the disk for every possible file.
+        
+        :returns: The size of each data file, keyed on filename
+        :rtype: dict
+        '''
+        with os.scandir(self.path) as entries:
+            return {entry.name: entry.stat().st_size for entry in entries if entry.name.endswith('.nc')}
+    
+    def _remove_partial_downloads(self):
+        ''' Removes any partially downloaded files left behind by a previous run which was killed.
+        
+        Partial files are named after the process writing them, so those belonging to a process
+        which is still running (e.g. another download into the same directory) are left alone.
+        '''
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if '.nc.partial.' in entry.name:
+                    pid = entry.name.split('.nc.partial.', 1)[1].split('.', 1)[0]
+                    if pid.isdigit() and __process_is_running__(int(pid)):
+                        continue
+                    logger.info('Removing partial download %s', entry.name)
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        # Its process finished with it since the directory was listed
+                        pass
+    
+    def _submit_request(self, key, request_params):
+        ''' Submits a request to MARS, waiting until there is a free request slot for the user.
+        
+        The request is recorded in the request cache as soon as it is submitted.  If a request for
+        the same target was submitted by an earlier run and is still known to ECMWF, it is resumed instead.
+        
+        :param key: The ECMWF API key/email pair to use
+        :param request_params: The dictionary for the ECMWF request
+        :type key: tuple
+        :type request_params: dict
+        
+        :returns: A connection to the submitted request.  This holds a request slot until passed to _await_and_download,
+                  unless it is a resumed request which MARS has aborted
+        :rtype: ecmwfapi.api.Connection
+        '''
+        target = request_params['target']
+        connection = self._resume_request(request_params)
+        if connection is not None:
+            if connection.status != 'aborted':
+                self._get_request_slot(connection.email).acquire()
+            return connection
+        
+        slot = self._get_request_slot(key[1])
+        slot.acquire()
+        try:
+            connection = self._connect(key)
+            connection.submit(f"{connection.url}/datasets/{request_params['dataset']}/requests", request_params)
+            logger.info('Submitted request %s for %s', connection.last.get('name'), target)
+            self._cache_request(request_params, connection)
+        except:
+            slot.release()
+            raise
+        return connection
+    
+    def _await_and_download(self, connection, target, local_conversion=False):
+        ''' Waits for a submitted request to complete, then downloads the result.
+        
+        :param connection: The connection returned by _submit_request
+        :param target: The filename to write the data to
+        :param local_conversion: Whether the request is for GRIB which needs converting to NetCDF
+        :type connection: ecmwfapi.api.Connection
+        :type target: string
+        :type local_conversion: boolean
+        '''
+        try:
+            while not connection.ready():
+                connection.wait()
+        finally:
+            # The request is finished with on MARS, so let the next one be submitted while this downloads
+            self._get_request_slot(connection.email).release()
+        
+        result = connection.result()
+        # Download to a temporary file which is renamed once complete.  That way, an interrupted
+        # download can never leave a truncated file which looks like it has already been downloaded.
+        partial_target = f'{target}.partial.{os.getpid()}'
+        partial_grib = partial_target + '.grib'
+        try:
+            if local_conversion:
+                __transfer__(urljoin(connection.url, result['href']), partial_grib, result['size'])
+                # The conversion runs in its own process, so other threads carry on downloading meanwhile
+                subprocess.check_call(['grib_to_netcdf', '-o', partial_target, partial_grib])
+                os.remove(partial_grib)
+            else:
+                __transfer__(urljoin(connection.url, result['href']), partial_target, result['size'])
+            os.replace(partial_target, target)
+            __drop_page_cache__(target)
+        except:
+            for partial in (partial_target, partial_grib):
+                if os.path.exists(partial):
+                    os.remove(partial)
+            raise
+        # Only forget about the request once we have the data.  If the transfer fails, the
+        # next run will download the result of this request again.
+        connection.cleanup()
+        self._forget_request(target)
+    
+    def _resume_request(self, request_params):
+        ''' Looks for a previously submitted request for the given target in the request cache.
+        The cached request is only resumed if it was for the same format (GRIB or NetCDF).
+        If MARS has aborted the request, it is still returned so that the forecast is not requested again.
+        
+        :param request_params: The dictionary for the ECMWF request
+        :type request_params: dict
+        
+        :returns: A connection to the existing request, or None if there is no request to resume
+        :rtype: ecmwfapi.api.Connection
+        '''
+        target = request_params['target']
+        with self.lock:
+            cached = self._request_cache.get(os.path.basename(target))
+        if cached is None:
+            return None
+        # Requests can only be followed using the key they were submitted with
+        keys = [key for key in self.keys if key[1] == cached['email']]
+        if len(keys) > 0:
+            connection = self._connect(keys[0])
+            connection.location = cached['location']
+            if cached.get('format') != request_params['format']:
+                # The cached request would produce data in the wrong format, so cancel it and start again
+                logger.info('Not resuming request %s for %s, which was for a different format', cached['request_id'], target)
+                connection.cleanup()
+                self._forget_request(target)
+                return None
+            try:
+                connection.call(connection.location)
+                logger.info('Resuming request %s for %s', cached['request_id'], target)
+                return connection
+            except (HTTPError, APIException):
+                # ECMWF no longer knows about this request, or it has failed.  If MARS aborted it,
+                # a new request would fail in the same way, so hand it back to be recorded as unavailable
+                if connection.status == 'aborted':
+                    return connection
+        self._forget_request(target)
+        return None
+    
+    def _cache_request(self, request_params, connection):
+        ''' Records a newly submitted request in the request cache.
+        
+        :param request_params: The dictionary for the ECMWF request
+        :param connection: The connection used to submit the request
+        :type request_params: dict
+        :type connection: ecmwfapi.api.Connection
+        '''
+        with self.lock:
+            self._request_cache[os.path.basename(request_params['target'])] = {
+                'request_id': connection.last.get('name'),
+                'location': connection.location,
+                'format': request_params['format'],
+                'email': connection.email,
+                'submitted_at': time.time()
+            }
+            self._save_request_cache()
+    
+    def _connect(self, key):
+        ''' Creates a connection to the ECMWF API for a key.
+        
+        :param key: The ECMWF API key/email pair to use
+        :type key: tuple
+        
+        :rtype: ecmwfapi.api.Connection
+        '''
+        return Connection(WildfireTiggeDataRetriever.api_url, email=key[1], key=key[0])
+    
+    def _get_request_slot(self, email):
+        ''' Gets the semaphore limiting the outstanding MARS requests for a user.  This is created
+        on first use for a key which the retriever was not constructed with.
+        
+        :param email: The email address of the ECMWF user
+        :type email: string
+        
+        :rtype: threading.BoundedSemaphore
+        '''
+        with self.lock:
+            return self._request_slots.setdefault(email, BoundedSemaphore(WildfireTiggeDataRetriever.requests_per_key))
+    
+    def _forget_request(self, target):
+        ''' Removes a request from the request cache.
+        
+        :param target: The target filename of the request
+        :type target: string
+        '''
+        with self.lock:
+            if self._request_cache.pop(os.path.basename(target), None) is not None:
+                self._save_request_cache()
+    
+    def _load_request_cache(self):
+        ''' Loads the request cache from disk.  self.lock should be held when calling this.
+        
+        :returns: The cached requests, keyed on target filename
+        :rtype: dict
+        '''
+        return __load_json__(self._request_cache_path)
+    
+    def _save_request_cache(self):
+        ''' Writes the request cache to disk.  self.lock should be held when calling this.
+        '''
+        __save_json__(self._request_cache_path, self._request_cache)
+    
+    def _is_unavailable(self, year, month, day, hour):
+        ''' Checks whether a forecast is known to be unavailable, either because it is one of the
+        missing_dates or because MARS failed to retrieve it within the last unavailable_recheck_interval.
+        
+        :param year: The year of the forecast
+        :param month: The month of the forecast
+        :param day: The day of the forecast
+        :param hour: The hour of the forecast (0,6,12,18)
+        :type year: int
+        :type month: int
+        :type day: int
+        :type hour: int
+        
+        :returns: Whether the forecast should not be requested
+        :rtype: boolean
+        '''
+        if (year,month,day) in WildfireTiggeDataRetriever.missing_dates:
+            return True
+        failed_at = self._unavailable.get(__format_forecast__(year, month, day, hour))
+        return failed_at is not None and failed_at > time.time() - WildfireTiggeDataRetriever.unavailable_recheck_interval
+    
+    def _mark_unavailable(self, year, month, day, hour):
+        ''' Records that MARS has failed to retrieve a forecast, so that it is not requested
+        again until unavailable_recheck_interval has passed.
+        
+        :param year: The year of the forecast
+        :param month: The month of the forecast
+        :param day: The day of the forecast
+        :param hour: The hour of the forecast (0,6,12,18)
+        :type year: int
+        :type month: int
+        :type day: int
+        :type hour: int
+        '''
+        with self.lock:
+            self._unavailable[__format_forecast__(year, month, day, hour)] = time.time()
+            __save_json__(self._unavailable_path, self._unavailable)
+    
+    def _load_unavailable(self):
+        ''' Loads the recently unavailable forecasts from disk, dropping any which are due to be
+        checked again.  self.lock should be held when calling this.
+        
+        :returns: The time at which MARS failed to retrieve each forecast, keyed on forecast date/time
+        :rtype: dict
+        '''
+        recheck_after = time.time() - WildfireTiggeDataRetriever.unavailable_recheck_interval
+        return {forecast: failed_at for forecast, failed_at in __load_json__(self._unavailable_path).items()
+                if failed_at > recheck_after}
+    
     def _get_ecmwf_key(self):
         ''' Gets the next ECMWF key ready to use.
         Cycles through the keys to maintain a balanced load on the requests.
@@ -191,11 +612,8 @@ class WildfireTiggeDataRetriever():
         :returns: The ECMWF key information
         :rtype: tuple containing (api_key, associated_email)
         '''
-        key = self.keys[self.current_key]
-        self.current_key += 1
-        if self.current_key >= len(self.keys):
-            self.current_key = 0
-        return key
+        # next() on a cycle is a single call into C, so this is safe to share between threads
+        return next(self._key_cycle)
     
     def _get_filename(self, year, month, day, hour, reduced_set=False):
         ''' Gets the filename to use for the given variables.
@@ -214,32 +632,122 @@ class WildfireTiggeDataRetriever():
         :returns: The target filename
         :rtype: string
         '''
-        
-        filename = self.path+__format_date__(year, month, day)+'T%02i-wildfire' % hour
-        if reduced_set:
-            filename += '-reduced.nc'
-        else:
-            filename += '.nc'
-        return filename
+        return __get_filename__(self.path, year, month, day, hour, reduced_set)
     
     
+# These are called for every forecast, often more than once, with a bounded set of arguments:
+# there are only a few thousand dates in TIGGE, with 4 forecasts per day.
+@lru_cache(maxsize=None)
 def __format_date__(year, month, day):
-    return "%04i-%02i-%02i" % (year,month,day)
+    return f"{year:04d}-{month:02d}-{day:02d}"
 
+@lru_cache(maxsize=None)
 def __format_time__(hour):
-    return "%02i:00:00" % hour
+    return f"{hour:02d}:00:00"
 
-def __get_data_wrapper__(args):
-    # This just wraps the get_data function, because instance methods cannot be
-    # used in a multiprocessing pool.  Wrapping them like this works fine
-    # BUT NOT ON WINDOWS.
+@lru_cache(maxsize=None)
+def __format_forecast__(year, month, day, hour):
+    return f"{__format_date__(year, month, day)}T{hour:02d}"
+
+@lru_cache(maxsize=None)
+def __get_filename__(path, year, month, day, hour, reduced_set):
+    filename = f"{path}{__format_forecast__(year, month, day, hour)}-wildfire"
+    if reduced_set:
+        filename += '-reduced.nc'
+    else:
+        filename += '.nc'
+    return filename
+
+def __load_json__(path):
+    # Loads one of the JSON files kept in the data directory, treating a missing or corrupt file as empty
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except ValueError:
+        logger.warning('%s is corrupt, ignoring it', path)
+        return {}
+
+def __save_json__(path, data):
+    # Writes to a temporary file which is then renamed, so that an interruption can
+    # never leave a half-written file behind
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(temp_path, path)
+
+def __transfer__(url, target, size):
+    # Streams the result of a completed request into the target file, checking that it arrived intact:
+    # its length must match both MARS and the HTTP response, and its content must match the
+    # Content-MD5 header if the server sends one.  The file is hashed as it is written, so it is never read back.
+    with urlopen(url) as response:
+        content_length = response.headers.get('Content-Length')
+        content_md5 = response.headers.get('Content-MD5')
+        md5 = hashlib.md5() if content_md5 else None
+        with open(target, 'wb') as target_file:
+            while True:
+                chunk = response.read(1048576)
+                if not chunk:
+                    break
+                target_file.write(chunk)
+                if md5 is not None:
+                    md5.update(chunk)
+    received = os.path.getsize(target)
+    if received != size or (content_length is not None and received != int(content_length)):
+        raise ConnectionError(f'Transfer of {target} was incomplete: received {received} of {size} bytes')
+    # RFC 1864 specifies base64, but accept a hex digest too
+    if md5 is not None and content_md5.strip() not in (base64.b64encode(md5.digest()).decode('ascii'), md5.hexdigest()):
+        raise ConnectionError(f'Transfer of {target} was corrupted: its MD5 does not match the Content-MD5 header')
+
+def __check_grib_to_netcdf__():
+    # Local conversion needs the grib_to_netcdf tool from ecCodes
+    if shutil.which('grib_to_netcdf') is None:
+        raise RuntimeError('local_conversion needs the grib_to_netcdf tool from ecCodes, which is not on the path')
+
+def __process_is_running__(pid):
+    # Signal 0 only checks whether the process exists.  On Windows, os.kill would actually
+    # send a signal, so assume the process is running and leave its files alone.
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user
+        return True
+    return True
+
+def __drop_page_cache__(path):
+    # Downloaded files are never read back by this module, so tell the kernel not to keep them in
+    # the page cache, where they would push out more useful pages.  Dirty pages cannot be dropped,
+    # so the file is flushed to disk first.  This is only advice, so any failure is ignored.
+    if not hasattr(os, 'posix_fadvise'):
+        return
     try:
-        args[0].get_data(args[1], args[2], args[3], args[4], args[5], args[6], args[7])
-    except:
-        print('Problem with args: %s %s %s %s %s %s %s: %s' % (args[1],args[2],args[3],args[4],args[5],args[6],args[7],traceback.format_exc()))
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def __is_transient__(error):
+    # Network problems and server-side HTTP errors are usually temporary on the ECMWF API.
+    # Other HTTP errors (e.g. a bad key) will fail the same way every time.
+    # The API client retries these itself for a short while before raising RetryError,
+    # so that is worth another try after a longer wait.
+    if isinstance(error, HTTPError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, (RetryError, URLError, HTTPException, ConnectionError, socket.timeout))
 
 if __name__ == '__main__':
     # Example usage
+    # Progress is reported through the logging module
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(message)s')
     data_dir = '/path/to/data/dir'
     ecmwf_keys = [('abcdefg-thisistheecmwfkey','email@domain.com')]
     # Create a data downloader, with a target directory and the ECMWF keys